@@ -1,8 +1,13 @@
 import os
 import json
 import csv
+import hmac
+import html
+import re
+import time
 from io import StringIO
-from typing import Dict
+from types import MappingProxyType
+from typing import Dict, Optional
 
 import requests
 import streamlit as st
@@ -15,29 +20,15 @@ st.set_page_config(page_title="D&D Party Tracker", page_icon="☀️", layout="w
 # ---- Background image (URL) ----
 BACKGROUND_URL = "https://i.pinimg.com/1200x/da/e2/ab/dae2ab85ba612195ad5f49ba2dc8138e.jpg"  # <-- change me
 
-st.markdown(f"""
+# --- page background, glassy panels & badges (one <style> block) ---
+PAGE_CSS = f"""
 <style>
 /* App background */
 .stApp {{
   background: url('{BACKGROUND_URL}') no-repeat center center fixed;
   background-size: cover;
 }}
-/* Make the main content readable on top of the image */
-.block-container {{
-  background: rgba(255,255,255,0.88);
-  border-radius: 18px;
-  padding: 1.5rem 2rem;
-}}
-/* Sidebar background */
-[data-testid="stSidebar"] > div:first-child {{
-  background: rgba(255,255,255,0.9);
-}}
-</style>
-""", unsafe_allow_html=True)
-
-# --- glassy panels & badges ---
-st.markdown("""
-<style>
+""" + """
 :root{
   --panel-alpha: 0.45;      /* transparency (0=transparent, 1=solid) */
   --panel-bg: 255,255,255;  /* white glass; use 17,24,39 for dark glass */
@@ -125,6 +116,16 @@ st.markdown("""
 }
 
 
+/* quest / item chips */
+.chip{
+  display: inline-block;
+  padding: 4px 10px;
+  margin: 3px;
+  border-radius: 999px;
+  border: 1px solid #e5e7eb;
+  background: #f8fafc;
+}
+
 /* muted helper text */
 .muted{
   color:#6b7280; 
@@ -140,34 +141,53 @@ h1, h2, h3, h4, h5, h6,
 }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(PAGE_CSS, unsafe_allow_html=True)
 
 # -----------------------------
 # Data model (single party record)
 # -----------------------------
-PARTY_FIELDS = [
+PARTY_FIELDS = (
     "Level",
     "Session Date",
     "Location",
     "What Happened Last",
     "Quest Hooks",
     "Loot/Rewards",
-]
+)
+
+_DEFAULTS = MappingProxyType({k: "" for k in PARTY_FIELDS})
 
 CSV_FALLBACK_PATH = "party_state.csv"
 
+# Header row + the single record row, e.g. "A1:F2" for six fields.
+SHEET_RANGE = f"A1:{chr(64 + len(PARTY_FIELDS))}2"
+
+# How long a fetched party record is reused across reruns before re-reading the backend.
+# Every successful write_party clears the cache, so this only bounds staleness from outside edits.
+READ_TTL_SECONDS = 60
+
 # -----------------------------
 # Backends: Gist (primary), Google Sheets (optional), Local CSV (fallback)
 # -----------------------------
 def use_gist() -> bool:
-    s = st.secrets
-    return bool(s.get("GIST_TOKEN", "")) and bool(s.get("GIST_ID", "")) and bool(s.get("GIST_FILENAME", ""))
+    try:
+        s = st.secrets
+        return bool(s.get("GIST_TOKEN", "")) and bool(s.get("GIST_ID", "")) and bool(s.get("GIST_FILENAME", ""))
+    except Exception:
+        # No secrets.toml (e.g. local dev): Gist backend is simply not configured.
+        return False
 
-def _gist_headers() -> dict:
-    return {
-        "Authorization": f"token {st.secrets['GIST_TOKEN']}",
+@st.cache_resource(show_spinner=False)
+def _gist_http(token: str) -> requests.Session:
+    """Return a pooled, pre-authenticated session so GitHub connections stay alive across reruns."""
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"token {token}",
         "Accept": "application/vnd.github+json",
-    }
+    })
+    return session
 
 def _gist_get_raw_url(gist_json: dict, filename: str) -> str:
     files = gist_json.get("files", {})
@@ -175,25 +195,47 @@ def _gist_get_raw_url(gist_json: dict, filename: str) -> str:
         return files[filename]["raw_url"]
     return ""
 
-def _gist_read_file() -> str:
-    """Return CSV text from the gist, or empty string."""
-    gist_id = st.secrets["GIST_ID"]
-    filename = st.secrets["GIST_FILENAME"]
-    r = requests.get(f"https://api.github.com/gists/{gist_id}", headers=_gist_headers(), timeout=20)
-    r.raise_for_status()
-    raw_url = _gist_get_raw_url(r.json(), filename)
+@st.cache_resource(show_spinner=False)
+def _gist_etag_cache() -> dict:
+    """Process-wide {(gist_id, filename): (etag, text)} for conditional Gist reads."""
+    return {}
+
+def _gist_file_text(http: requests.Session, gist_json: dict, filename: str) -> str:
+    # The API inlines file content (up to ~1 MB); only fall back to raw_url if truncated.
+    file_info = gist_json.get("files", {}).get(filename, {})
+    if "content" in file_info and not file_info.get("truncated"):
+        return file_info["content"]
+    raw_url = _gist_get_raw_url(gist_json, filename)
     if not raw_url:
         return ""
-    rr = requests.get(raw_url, timeout=20)
+    # raw_url lives on gist.githubusercontent.com; keep the PAT on api.github.com only.
+    rr = http.get(raw_url, headers={"Authorization": None}, timeout=20)
     if rr.status_code == 200:
         return rr.text
     return ""
 
+def _gist_read_file() -> str:
+    """Return CSV text from the gist, or empty string."""
+    gist_id = st.secrets["GIST_ID"]
+    filename = st.secrets["GIST_FILENAME"]
+    http = _gist_http(st.secrets["GIST_TOKEN"])
+    etags = _gist_etag_cache()
+    cached = etags.get((gist_id, filename))
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    r = http.get(f"https://api.github.com/gists/{gist_id}", headers=headers, timeout=20)
+    if r.status_code == 304 and cached:
+        return cached[1]
+    r.raise_for_status()
+    text = _gist_file_text(http, r.json(), filename)
+    if text and r.headers.get("ETag"):  # "" may be a failed raw_url fetch; don't pin it
+        etags[(gist_id, filename)] = (r.headers["ETag"], text)
+    return text
+
 def _gist_write_file(csv_text: str):
     gist_id = st.secrets["GIST_ID"]
     filename = st.secrets["GIST_FILENAME"]
     payload = {"files": {filename: {"content": csv_text}}}
-    r = requests.patch(f"https://api.github.com/gists/{gist_id}", headers=_gist_headers(), json=payload, timeout=20)
+    r = _gist_http(st.secrets["GIST_TOKEN"]).patch(f"https://api.github.com/gists/{gist_id}", json=payload, timeout=20)
     r.raise_for_status()
 
 def use_gsheets() -> bool:
@@ -214,30 +256,48 @@ def _get_gsheets_client():
         client = gspread.authorize(creds)
         sh = client.open_by_url(sheet_name) if sheet_name.startswith("http") else client.open(sheet_name)
         try:
-            ws = sh.worksheet("Party")
-        except Exception:
+            ws = sh.worksheet("Party")  # single metadata fetch; no separate existence check
+        except gspread.WorksheetNotFound:
+            # No header append here: read_party treats an empty sheet as defaults,
+            # and write_party writes header + record together.
             ws = sh.add_worksheet(title="Party", rows=50, cols=10)
-            ws.append_row(PARTY_FIELDS)
         return ws
     except Exception as e:
         st.warning(f"Google Sheets not available ({e}). Falling back to CSV.")
         return None
 
 def _defaults() -> Dict[str, str]:
-    return {k: "" for k in PARTY_FIELDS}
+    return dict(_DEFAULTS)
+
+def _parse_party_csv(lines) -> Dict[str, str]:
+    """Parse header + first record from CSV lines into a party dict."""
+    rows = csv.reader(lines)
+    header = next(rows, [])
+    values = next(rows, None)
+    if values is None:
+        return _defaults()
+    if tuple(header) == PARTY_FIELDS and len(values) == len(PARTY_FIELDS):
+        return dict(zip(PARTY_FIELDS, values))  # the layout write_party produces
+    data = dict(zip(header, values))
+    return {k: data.get(k, "") for k in PARTY_FIELDS}
 
 def read_party() -> Dict[str, str]:
-    """Read the single party record."""
+    """Read the single party record.
+
+    Right after a save, this session reuses the record it just wrote instead of
+    re-reading the backend. Otherwise each backend fetch is cached across reruns;
+    only successful fetches are cached, so a failed read is retried next rerun.
+    """
+    written = st.session_state.get("_party_written")
+    if written is not None and time.monotonic() - written[1] < READ_TTL_SECONDS:
+        return dict(written[0])
+
     # 1) Gist (primary)
     if use_gist():
         try:
-            text = _gist_read_file()
-            if text.strip():
-                lines = text.splitlines()
-                reader = csv.DictReader(lines)
-                for r in reader:
-                    return {k: r.get(k, "") for k in PARTY_FIELDS}  # first row only
-                return _defaults()
+            data = _fetch_gist_party(st.secrets["GIST_ID"], st.secrets["GIST_FILENAME"])
+            if data is not None:
+                return data
         except Exception as e:
             st.warning(f"Gist read failed: {e}")
 
@@ -245,26 +305,63 @@ def read_party() -> Dict[str, str]:
     if use_gsheets():
         ws = _get_gsheets_client()
         if ws is not None:
-            vals = ws.get_all_values()
-            if not vals or len(vals) < 2:
-                return _defaults()
-            header = vals[0]
-            row = vals[1]
-            data = dict(zip(header, row))
-            for k in PARTY_FIELDS:
-                data.setdefault(k, "")
-            return {k: data[k] for k in PARTY_FIELDS}
+            return _fetch_sheets_party(os.environ["GSHEETS_SHEET_NAME"], ws)
 
     # 3) Local CSV (fallback)
-    if os.path.exists(CSV_FALLBACK_PATH):
-        try:
-            with open(CSV_FALLBACK_PATH, "r", encoding="utf-8", newline="") as f:
-                reader = csv.DictReader(f)
-                for r in reader:
-                    return {k: r.get(k, "") for k in PARTY_FIELDS}
-        except Exception:
-            pass
-    return _defaults()
+    try:
+        return _fetch_csv_party(CSV_FALLBACK_PATH)
+    except Exception:
+        return _defaults()
+
+@st.cache_data(ttl=READ_TTL_SECONDS, show_spinner=False)
+def _fetch_gist_party(gist_id: str, filename: str) -> Optional[Dict[str, str]]:
+    """Party record from the gist, or None if the file is empty. Errors propagate (not cached)."""
+    text = _gist_read_file()
+    if text.strip():
+        return _parse_party_csv(StringIO(text, newline=""))
+    return None
+
+@st.cache_data(ttl=READ_TTL_SECONDS, show_spinner=False)
+def _fetch_sheets_party(sheet_name: str, _ws) -> Dict[str, str]:
+    """Party record from the worksheet; ``sheet_name`` keys the cache so sheets don't collide."""
+    vals = _ws.get(SHEET_RANGE)
+    if not vals or len(vals) < 2:
+        return _defaults()
+    header = vals[0]
+    row = vals[1]
+    data = dict(zip(header, row))
+    for k in PARTY_FIELDS:
+        data.setdefault(k, "")
+    return {k: data[k] for k in PARTY_FIELDS}
+
+@st.cache_data(ttl=READ_TTL_SECONDS, show_spinner=False)
+def _fetch_csv_party(path: str) -> Dict[str, str]:
+    """Party record from the local CSV; a missing file means nothing saved yet."""
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            return _parse_party_csv(f)
+    except FileNotFoundError:
+        return _defaults()
+
+def _remember_write(data: Dict[str, str]):
+    """Drop the shared read caches and keep the saved record for this session's next rerun."""
+    _fetch_gist_party.clear()
+    _fetch_sheets_party.clear()
+    _fetch_csv_party.clear()
+    st.session_state["_party_written"] = (data, time.monotonic())
+
+def _csv_escape(v: str) -> str:
+    """Quote a CSV field only when needed (same rules as csv.QUOTE_MINIMAL)."""
+    if any(c in v for c in ',"\n\r'):
+        return '"' + v.replace('"', '""') + '"'
+    return v
+
+def _party_csv(data: Dict[str, str]) -> str:
+    """Serialize the party record as header + one row of CSV text."""
+    return (
+        ",".join(_csv_escape(k) for k in PARTY_FIELDS) + "\n"
+        + ",".join(_csv_escape(data[k]) for k in PARTY_FIELDS) + "\n"
+    )
 
 def write_party(data: Dict[str, str]):
     """Write the single party record."""
@@ -273,11 +370,8 @@ def write_party(data: Dict[str, str]):
     # 1) Gist (primary)
     if use_gist():
         try:
-            buf = StringIO()
-            writer = csv.DictWriter(buf, fieldnames=PARTY_FIELDS)
-            writer.writeheader()
-            writer.writerow(data)
-            _gist_write_file(buf.getvalue())
+            _gist_write_file(_party_csv(data))
+            _remember_write(data)
             return
         except Exception as e:
             st.error(f"Gist write failed: {e}")
@@ -286,33 +380,35 @@ def write_party(data: Dict[str, str]):
     if use_gsheets():
         ws = _get_gsheets_client()
         if ws is not None:
-            ws.clear()
-            ws.append_row(PARTY_FIELDS)
-            ws.append_row([data[k] for k in PARTY_FIELDS])
+            # One request for header + row; overwriting the fixed range makes a clear unnecessary.
+            ws.update(
+                range_name=SHEET_RANGE,
+                values=[list(PARTY_FIELDS), [data[k] for k in PARTY_FIELDS]],
+                value_input_option="RAW",
+            )
+            _remember_write(data)
             return
 
     # 3) Local CSV (fallback)
     try:
         with open(CSV_FALLBACK_PATH, "w", encoding="utf-8", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=PARTY_FIELDS)
-            writer.writeheader()
-            writer.writerow(data)
+            f.write(_party_csv(data))
+        _remember_write(data)
     except Exception as e:
         st.error(f"Could not save CSV: {e}")
 
 # -----------------------------
 # UI
 # -----------------------------
+_CHIP_SEP_RE = re.compile(r"[;,]")
+_CHIP_TMPL = "<span class='chip'>{}</span>"  # styled by .chip in PAGE_CSS
+
 def _chips(text: str) -> str:
     """Render comma/semicolon separated items as little pills."""
-    items = [x.strip() for x in str(text).replace(";", ",").split(",") if x.strip()]
+    items = [x.strip() for x in _CHIP_SEP_RE.split(str(text)) if x.strip()]
     if not items:
         return ""
-    pills = "".join(
-        f"<span style='display:inline-block;padding:4px 10px;margin:3px;border-radius:999px;border:1px solid #e5e7eb;background:#f8fafc'>{x}</span>"
-        for x in items
-    )
-    return pills
+    return "".join(_CHIP_TMPL.format(html.escape(x)) for x in items)
 
 def main():
     st.title("☀️ D&D Party Tracker")
@@ -335,7 +431,8 @@ def main():
         except Exception:
             return ""
     EDIT_KEY = _get_edit_key()
-    can_edit = bool(EDIT_KEY) and (provided_key == EDIT_KEY)
+    # Constant-time compare; bytes so non-ASCII keys don't raise TypeError.
+    can_edit = bool(EDIT_KEY) and hmac.compare_digest(provided_key.encode(), EDIT_KEY.encode())
 
     if can_edit:
         st.success("GM Edit Mode (key verified)")
@@ -381,7 +478,7 @@ def main():
         ec1, ec2, ec3 = st.columns(3)
         try:
             level_default = int(party.get("Level") or 1)
-        except Exception:
+        except ValueError:
             level_default = 1
         level = ec1.number_input("Level", min_value=1, max_value=30, value=level_default, step=1)
         session_date = ec2.text_input("Session Date (YYYY-MM-DD or text)", value=party.get("Session Date", ""))